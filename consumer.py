@@ -1,185 +1,648 @@
 import argparse
 import boto3
+import functools
 import logging
+import logging.handlers
+import orjson
+import queue
+import random
+import signal
+import threading
 import time
-import json
-
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        logging.FileHandler("consumer.log"),
-        logging.StreamHandler()
-    ]
+import types
+from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable
+from botocore.config import Config
+
+log = logging.getLogger(__name__)
+
+
+def setup_logging():
+    """Log through a queue so the request loop never waits on the log file.
+
+    Returns the started QueueListener; stop it on shutdown to drain the queue.
+    """
+    formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
+    file_handler = logging.FileHandler("consumer.log")
+    file_handler.setFormatter(formatter)
+    # The console only gets warnings and errors; per-request INFO goes to the file
+    stream_handler = logging.StreamHandler()
+    stream_handler.setLevel(logging.WARNING)
+    stream_handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+
+    listener = logging.handlers.QueueListener(
+        log_queue, file_handler, stream_handler, respect_handler_level=True
+    )
+    listener.start()
+    return listener
+
+
+# -----------------------------------------------------
+# Shared AWS clients
+# -----------------------------------------------------
+# boto3 clients are thread-safe and hold a pooled HTTPS connection, so one
+# per (service, region) is reused for the life of the process instead of
+# paying a fresh TCP/TLS handshake every time one is built. TCP keep-alive
+# stops idle pooled sockets from being reaped between polls, so the loop keeps
+# reusing the same connection (needs botocore >= 1.27.84, see requirements).
+_BOTO_CONFIG = Config(
+    max_pool_connections=50,
+    tcp_keepalive=True,
+    retries={"max_attempts": 5, "mode": "adaptive"}
 )
 
+_CLIENTS: dict[tuple[str, str], Any] = {}
+_RESOURCES: dict[tuple[str, str], Any] = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(service, region):
+    key = (service, region)
+    with _clients_lock:
+        if key not in _CLIENTS:
+            _CLIENTS[key] = boto3.client(service, region_name=region, config=_BOTO_CONFIG)
+        return _CLIENTS[key]
+
+
+def get_resource(service, region):
+    key = (service, region)
+    with _clients_lock:
+        if key not in _RESOURCES:
+            _RESOURCES[key] = boto3.resource(service, region_name=region, config=_BOTO_CONFIG)
+        return _RESOURCES[key]
+
+
 # -----------------------------------------------------
 # S3 Request Fetcher
 # -----------------------------------------------------
+# Empty polls back off exponentially (100ms -> 5s, plus jitter) so an idle
+# worker drops from ~10 ListObjects/s to well under one.
+S3_BACKOFF_BASE = 0.1
+S3_BACKOFF_MAX = 5.0
+
+
+def s3_backoff_delay(empty_polls):
+    # Cap the exponent so a long idle period can't overflow the float
+    delay = S3_BACKOFF_BASE * 2 ** min(empty_polls, 16)
+    return min(S3_BACKOFF_MAX, delay) + random.uniform(0, S3_BACKOFF_BASE)
+
+
+# Keys are listed up to 1000 at a time and their bodies fetched 16 at once
+# over the shared client's connection pool, then drained locally before
+# listing again, so ListObjects is paid once per batch rather than once per
+# request and GetObject latency overlaps instead of adding up.
+S3_LIST_BATCH = 1000
+S3_FETCH_WORKERS = 16
+# Cached requests are handed to the handler pool this many at a time
+S3_PROCESS_BATCH = 100
+
+_s3_fetch_pool = ThreadPoolExecutor(max_workers=S3_FETCH_WORKERS)
+_s3_request_cache: defaultdict[str, deque[tuple[str, bytes]]] = defaultdict(deque)
+
+
+def _get_request_s3(s3_client, bucket_name, key):
+    try:
+        obj = s3_client.get_object(Bucket=bucket_name, Key=key)
+    except s3_client.exceptions.NoSuchKey:
+        # Listed but already taken by another worker
+        return key, None
+    # Request bodies are UTF-8 JSON; keep the raw bytes for orjson rather
+    # than decoding to an intermediate str
+    return key, obj["Body"].read()
+
+
+def fetch_requests_s3(s3_client, bucket_name, limit):
+    """Return up to `limit` (key, body) pairs, listing only when none are cached."""
+    requests = _s3_request_cache[bucket_name]
+    if not requests:
+        # Finished keys must be gone before re-listing or they come back
+        flush_deletes_s3(s3_client, bucket_name)
+        resp = s3_client.list_objects_v2(Bucket=bucket_name, MaxKeys=S3_LIST_BATCH)
+        keys = [o["Key"] for o in resp.get("Contents", [])]
+        fetched = _s3_fetch_pool.map(lambda k: _get_request_s3(s3_client, bucket_name, k), keys)
+        requests.extend(r for r in fetched if r[1] is not None)
+
+    return [requests.popleft() for _ in range(min(limit, len(requests)))]
+
+
 def fetch_request_s3(s3_client, bucket_name):
-    resp = s3_client.list_objects_v2(Bucket=bucket_name, MaxKeys=1)
-    contents = resp.get("Contents", [])
-    if not contents:
+    fetched = fetch_requests_s3(s3_client, bucket_name, 1)
+    if not fetched:
         return None, None
+    return fetched[0]
 
-    key = contents[0]["Key"]
-    obj = s3_client.get_object(Bucket=bucket_name, Key=key)
-    body = obj["Body"].read().decode("utf-8")
-    return key, body
 
+# Processed requests are deleted with DeleteObjects, up to 1000 keys per call,
+# flushed when the batch fills, once a second, or on shutdown.
+S3_DELETE_BATCH = 1000
+S3_DELETE_INTERVAL = 1.0
 
-# -----------------------------------------------------
-# SQS Request Fetcher (with caching for up to 10 msgs)
-# -----------------------------------------------------
-_sqs_cache = []
+_s3_pending_deletes: defaultdict[str, list[str]] = defaultdict(list)
+_s3_last_flush: defaultdict[str, float] = defaultdict(time.monotonic)
 
-def fetch_request_sqs(sqs_client, queue_url):
-    global _sqs_cache
 
-    # Return cached messages first
-    if _sqs_cache:
-        return _sqs_cache.pop(0)
+def delete_request_s3(s3_client, bucket_name, key):
+    pending = _s3_pending_deletes[bucket_name]
+    pending.append(key)
+    if (len(pending) >= S3_DELETE_BATCH
+            or time.monotonic() - _s3_last_flush[bucket_name] > S3_DELETE_INTERVAL):
+        flush_deletes_s3(s3_client, bucket_name)
+
+
+def flush_deletes_s3(s3_client, bucket_name):
+    _s3_last_flush[bucket_name] = time.monotonic()
+    pending = _s3_pending_deletes[bucket_name]
+    if not pending:
+        return
+
+    resp = s3_client.delete_objects(
+        Bucket=bucket_name,
+        Delete={"Objects": [{"Key": k} for k in pending], "Quiet": True}
+    )
+    # Keys stay pending if the call itself raises, so the next flush retries them
+    pending.clear()
+    for err in resp.get("Errors", []):
+        log.error("Failed to delete request %s: %s", err["Key"], err.get("Message"))
+
 
+# -----------------------------------------------------
+# SQS Request Fetcher (with caching for up to 10 msgs)
+# -----------------------------------------------------
+# Long polling: receive_message blocks server-side for up to 20s instead of
+# returning empty, cutting idle API calls from ~10/s to ~0.05/s per worker.
+SQS_WAIT_SECONDS = 20
+SQS_BATCH_SIZE = 10
+
+# With --dead-letter-queue set, a message received more than this many times
+# is moved there instead of being reprocessed forever. Without it nothing is
+# dropped; use the queue's RedrivePolicy to cap retries instead.
+SQS_MAX_RECEIVES = 5
+
+# Leftover messages from a receive, per queue; shared by handler threads
+_sqs_cache: defaultdict[str, deque[dict[str, Any]]] = defaultdict(deque)
+_sqs_cache_lock = threading.Lock()
+
+
+def fetch_requests_sqs(sqs_client, queue_url, wait_seconds=SQS_WAIT_SECONDS):
+    # Hand back anything left over from the last receive first
+    with _sqs_cache_lock:
+        cache = _sqs_cache[queue_url]
+        if cache:
+            messages = list(cache)
+            cache.clear()
+            return messages
+
+    # Not held across the long poll, which would stall every other queue
     resp = sqs_client.receive_message(
         QueueUrl=queue_url,
-        MaxNumberOfMessages=10,
-        WaitTimeSeconds=1,
+        MaxNumberOfMessages=SQS_BATCH_SIZE,
+        WaitTimeSeconds=wait_seconds,
+        AttributeNames=["ApproximateReceiveCount"],
         MessageAttributeNames=["All"]
     )
-    messages = resp.get("Messages", [])
+    return resp.get("Messages", [])
+
+
+def fetch_request_sqs(sqs_client, queue_url, wait_seconds=SQS_WAIT_SECONDS):
+    # Return cached messages first
+    with _sqs_cache_lock:
+        cache = _sqs_cache[queue_url]
+        if cache:
+            return cache.popleft()
+
+    messages = fetch_requests_sqs(sqs_client, queue_url, wait_seconds)
     if not messages:
         return None
 
     # Cache remaining messages
-    _sqs_cache.extend(messages[1:])
+    with _sqs_cache_lock:
+        _sqs_cache[queue_url].extend(messages[1:])
 
     # Return first message
     return messages[0]
 
 
+def delete_requests_sqs(sqs_client, queue_url, receipts):
+    # DeleteMessageBatch takes up to 10 entries, one receive's worth
+    for start in range(0, len(receipts), SQS_BATCH_SIZE):
+        chunk = receipts[start:start + SQS_BATCH_SIZE]
+        resp = sqs_client.delete_message_batch(
+            QueueUrl=queue_url,
+            Entries=[{"Id": str(i), "ReceiptHandle": rh} for i, rh in enumerate(chunk)]
+        )
+        for failed in resp.get("Failed", []):
+            sqs_client.delete_message(
+                QueueUrl=queue_url,
+                ReceiptHandle=chunk[int(failed["Id"])]
+            )
+
+
+def is_poison_message(msg, max_receives=SQS_MAX_RECEIVES):
+    receives = int(msg.get("Attributes", {}).get("ApproximateReceiveCount", 1))
+    return receives > max_receives
+
+
+def dead_letter_sqs(sqs_client, dead_letter_url, msg):
+    # Received attributes carry extra fields send_message rejects
+    attributes = {
+        name: {k: v for k, v in attr.items() if k in ("DataType", "StringValue", "BinaryValue")}
+        for name, attr in msg.get("MessageAttributes", {}).items()
+    }
+    kwargs = {"MessageAttributes": attributes} if attributes else {}
+    sqs_client.send_message(QueueUrl=dead_letter_url, MessageBody=msg["Body"], **kwargs)
+
+
 # -----------------------------------------------------
-# Process Create Request
+# DynamoDB Batch Writer
 # -----------------------------------------------------
-def process_create_request(data, storage_type, s3_client=None, bucket_name=None,
-                           dynamo_table=None, queue_client=None, queue_url=None):
+# Puts and deletes are handed to background threads that combine whatever is
+# queued, up to 25 writes, into one BatchWriteItem call.
+DYNAMO_WRITERS = 8
+DYNAMO_BATCH = 25
+DYNAMO_QUEUE_SIZE = 10_000
+
+
+class DynamoBatchWriter:
+    """Batches DynamoDB puts and deletes submitted from many handler threads.
+
+    Each write returns a Future that resolves once its batch has been written,
+    so a request is only acknowledged after its write is durable. Writes to
+    the same id within a batch are collapsed, and boto3 retries
+    UnprocessedItems.
+    """
+
+    def __init__(self, dynamo_table, workers=DYNAMO_WRITERS):
+        self._table = dynamo_table
+        self._jobs = queue.Queue(maxsize=DYNAMO_QUEUE_SIZE)
+        for _ in range(workers):
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def put_item(self, Item):
+        return self._submit("put", Item)
+
+    def delete_item(self, Key):
+        return self._submit("delete", Key)
+
+    def _submit(self, op, payload):
+        future = Future()
+        self._jobs.put((op, payload, future))
+        return future
+
+    def _run(self):
+        while True:
+            jobs = [self._jobs.get()]
+            while len(jobs) < DYNAMO_BATCH:
+                try:
+                    jobs.append(self._jobs.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                with self._table.batch_writer(overwrite_by_pkeys=["id"]) as writer:
+                    for op, payload, _ in jobs:
+                        if op == "put":
+                            writer.put_item(Item=payload)
+                        else:
+                            writer.delete_item(Key=payload)
+            except Exception:
+                # One bad write fails the whole BatchWriteItem; replay the jobs
+                # one by one so only the bad write's request is retried
+                for job in jobs:
+                    self._write_one(*job)
+            else:
+                for _, _, future in jobs:
+                    future.set_result(None)
 
-    other_attrs = {a["name"]: a["value"] for a in data.get("otherAttributes", [])}
+    def _write_one(self, op, payload, future):
+        try:
+            if op == "put":
+                self._table.put_item(Item=payload)
+            else:
+                self._table.delete_item(Key=payload)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(None)
 
-    if storage_type == "bucket3":
-        key = f"widgets/{data['owner'].lower().replace(' ', '-')}/{data['widgetId']}"
-        s3_client.put_object(Bucket=bucket_name, Key=key, Body=json.dumps(data))
 
-    elif storage_type == "dynamodb":
-        item = {
-            "id": data["widgetId"],
-            "owner": data["owner"],
-            "label": data.get("label", ""),
-            "description": data.get("description", "")
-        }
-        item.update(other_attrs)
-        dynamo_table.put_item(Item=item)
+# -----------------------------------------------------
+# Widget Keys
+# -----------------------------------------------------
+# Owners repeat across requests while widget ids are unique, so only the
+# owner's slug is cached.
+@functools.lru_cache(maxsize=4096)
+def _owner_slug(owner: str) -> str:
+    return owner.lower().replace(" ", "-")
 
-    elif storage_type == "queue":
-        queue_client.send_message(
-            QueueUrl=queue_url,
-            MessageBody=json.dumps(data),
-            MessageAttributes={
-                "RequestType": {
-                    "DataType": "String",
-                    "StringValue": "create"
-                }
-            }
-        )
-    else:
-        raise ValueError("Invalid storage type")
+
+def _widget_key(owner: str, widget_id: object) -> str:
+    return f"widgets/{_owner_slug(owner)}/{widget_id}"
 
 
 # -----------------------------------------------------
-# Process Update Request
+# Handler Context
 # -----------------------------------------------------
-def process_update_request(data, storage_type, s3_client=None, bucket_name=None,
-                           dynamo_table=None, queue_client=None, queue_url=None):
+@dataclass(slots=True, frozen=True)
+class Ctx:
+    """Storage clients and targets, built once in main() and passed to every handler."""
 
-    other_attrs = {a["name"]: a["value"] for a in data.get("otherAttributes", [])}
+    s3_client: Any = None
+    bucket_name: str | None = None
+    dynamo_table: Any = None
+    dynamo_writer: DynamoBatchWriter | None = None
+    queue_client: Any = None
+    queue_url: str | None = None
 
-    if storage_type == "bucket3":
-        key = f"widgets/{data['owner'].lower().replace(' ', '-')}/{data['widgetId']}"
-        s3_client.put_object(Bucket=bucket_name, Key=key, Body=json.dumps(data))
 
-    elif storage_type == "dynamodb":
-        update_expr = "SET #label = :label, #description = :desc"
-        names = {"#label": "label", "#description": "description"}
-        values = {
-            ":label": data.get("label", ""),
-            ":desc": data.get("description", "")
+# -----------------------------------------------------
+# Storage Handlers
+# -----------------------------------------------------
+# One function per (operation, storage type)
+
+# Shared read-only stand-in for requests without otherAttributes
+_EMPTY: types.MappingProxyType[str, Any] = types.MappingProxyType({})
+
+
+def _put_bucket3(data: dict[str, Any], ctx: Ctx) -> None:
+    key = _widget_key(data["owner"], data["widgetId"])
+    ctx.s3_client.put_object(Bucket=ctx.bucket_name, Key=key, Body=orjson.dumps(data))
+
+
+def _create_dynamo(data: dict[str, Any], ctx: Ctx) -> None:
+    attrs_list = data.get("otherAttributes")
+    other_attrs = {a["name"]: a["value"] for a in attrs_list} if attrs_list else _EMPTY
+
+    item = {
+        "id": data["widgetId"],
+        "owner": data["owner"],
+        "label": data.get("label", ""),
+        "description": data.get("description", "")
+    }
+    item.update(other_attrs)
+    if ctx.dynamo_writer:
+        # Block until the batch lands so the request isn't acknowledged early
+        ctx.dynamo_writer.put_item(Item=item).result()
+    else:
+        ctx.dynamo_table.put_item(Item=item)
+
+
+def _create_queue(data: dict[str, Any], ctx: Ctx) -> None:
+    ctx.queue_client.send_message(
+        QueueUrl=ctx.queue_url,
+        MessageBody=orjson.dumps(data).decode(),
+        MessageAttributes={
+            "RequestType": {
+                "DataType": "String",
+                "StringValue": "create"
+            }
         }
+    )
 
-        for k, v in other_attrs.items():
-            safe = k.replace("-", "_")
-            update_expr += f", #{safe} = :{safe}"
-            names[f"#{safe}"] = k
-            values[f":{safe}"] = v
-
-        dynamo_table.update_item(
-            Key={"id": data["widgetId"]},
-            UpdateExpression=update_expr,
-            ExpressionAttributeNames=names,
-            ExpressionAttributeValues=values
-        )
 
-    elif storage_type == "queue":
-        queue_client.send_message(
-            QueueUrl=queue_url,
-            MessageBody=json.dumps({
-                "type": "update",
-                "widgetId": data["widgetId"],
-                "owner": data.get("owner"),
-                "timestamp": int(time.time())
-            }),
-            MessageAttributes={
-                "UpdateType": {
-                    "DataType": "String",
-                    "StringValue": "update"
-                }
+# Attribute names repeat across messages (color, size, ...), so each one's
+# placeholders and SET clause are built once per process
+@functools.lru_cache(maxsize=1024)
+def _attr_placeholders(name: str) -> tuple[str, str, str]:
+    safe = name.replace("-", "_")
+    return f"#{safe} = :{safe}", f"#{safe}", f":{safe}"
+
+
+def _update_dynamo(data: dict[str, Any], ctx: Ctx) -> None:
+    attrs_list = data.get("otherAttributes")
+    other_attrs = {a["name"]: a["value"] for a in attrs_list} if attrs_list else _EMPTY
+
+    parts = ["SET #label = :label", "#description = :desc"]
+    names = {"#label": "label", "#description": "description"}
+    values = {
+        ":label": data.get("label", ""),
+        ":desc": data.get("description", "")
+    }
+
+    for k, v in other_attrs.items():
+        clause, name_ph, value_ph = _attr_placeholders(k)
+        parts.append(clause)
+        names[name_ph] = k
+        values[value_ph] = v
+
+    # Joined once rather than grown with += per attribute
+    update_expr = ", ".join(parts)
+
+    # update_item can't be batched; earlier writes for this widget have already
+    # landed because batched writes are waited on
+    ctx.dynamo_table.update_item(
+        Key={"id": data["widgetId"]},
+        UpdateExpression=update_expr,
+        ExpressionAttributeNames=names,
+        ExpressionAttributeValues=values
+    )
+
+
+def _update_queue(data: dict[str, Any], ctx: Ctx) -> None:
+    ctx.queue_client.send_message(
+        QueueUrl=ctx.queue_url,
+        MessageBody=orjson.dumps({
+            "type": "update",
+            "widgetId": data["widgetId"],
+            "owner": data.get("owner"),
+            "timestamp": int(time.time())
+        }).decode(),
+        MessageAttributes={
+            "UpdateType": {
+                "DataType": "String",
+                "StringValue": "update"
             }
-        )
+        }
+    )
+
+
+def _delete_bucket3(data: dict[str, Any], ctx: Ctx) -> None:
+    key = _widget_key(data["owner"], data["widgetId"])
+    ctx.s3_client.delete_object(Bucket=ctx.bucket_name, Key=key)
+
 
+def _delete_dynamo(data: dict[str, Any], ctx: Ctx) -> None:
+    key = {"id": data["widgetId"]}
+    if ctx.dynamo_writer:
+        ctx.dynamo_writer.delete_item(Key=key).result()
     else:
-        raise ValueError("Invalid storage type")
+        ctx.dynamo_table.delete_item(Key=key)
+
+
+def _delete_queue(data: dict[str, Any], ctx: Ctx) -> None:
+    ctx.queue_client.send_message(
+        QueueUrl=ctx.queue_url,
+        MessageBody=orjson.dumps({
+            "type": "delete",
+            "widgetId": data["widgetId"],
+            "owner": data.get("owner"),
+            "timestamp": int(time.time())
+        }).decode(),
+        MessageAttributes={
+            "DeleteType": {
+                "DataType": "String",
+                "StringValue": "delete"
+            }
+        }
+    )
+
+
+_DISPATCH: dict[tuple[str, str], Callable[[dict[str, Any], Ctx], None]] = {
+    ("create", "bucket3"): _put_bucket3,
+    ("create", "dynamodb"): _create_dynamo,
+    ("create", "queue"): _create_queue,
+    ("update", "bucket3"): _put_bucket3,
+    ("update", "dynamodb"): _update_dynamo,
+    ("update", "queue"): _update_queue,
+    ("delete", "bucket3"): _delete_bucket3,
+    ("delete", "dynamodb"): _delete_dynamo,
+    ("delete", "queue"): _delete_queue,
+}
+
+
+def storage_handler(operation: str, storage_type: str) -> Callable[[dict[str, Any], Ctx], None]:
+    try:
+        return _DISPATCH[(operation, storage_type)]
+    except KeyError:
+        raise ValueError("Invalid storage type") from None
 
 
 # -----------------------------------------------------
-# Process Delete Request
+# Process Create / Update / Delete Requests
 # -----------------------------------------------------
-def process_delete_request(data, storage_type, s3_client=None, bucket_name=None,
-                           dynamo_table=None, queue_client=None, queue_url=None):
+def process_create_request(data: dict[str, Any], storage_type: str, ctx: Ctx) -> None:
+    storage_handler("create", storage_type)(data, ctx)
 
-    if storage_type == "bucket3":
-        key = f"widgets/{data['owner'].lower().replace(' ', '-')}/{data['widgetId']}"
-        s3_client.delete_object(Bucket=bucket_name, Key=key)
 
-    elif storage_type == "dynamodb":
-        dynamo_table.delete_item(Key={"id": data["widgetId"]})
+def process_update_request(data: dict[str, Any], storage_type: str, ctx: Ctx) -> None:
+    storage_handler("update", storage_type)(data, ctx)
 
-    elif storage_type == "queue":
-        queue_client.send_message(
-            QueueUrl=queue_url,
-            MessageBody=json.dumps({
-                "type": "delete",
-                "widgetId": data["widgetId"],
-                "owner": data.get("owner"),
-                "timestamp": int(time.time())
-            }),
-            MessageAttributes={
-                "DeleteType": {
-                    "DataType": "String",
-                    "StringValue": "delete"
-                }
-            }
-        )
 
+def process_delete_request(data: dict[str, Any], storage_type: str, ctx: Ctx) -> None:
+    storage_handler("delete", storage_type)(data, ctx)
+
+
+# -----------------------------------------------------
+# Request Dispatch
+# -----------------------------------------------------
+# Request "type" (or legacy "event") -> handler; one dict lookup per request
+_HANDLERS: dict[str, Callable[[dict[str, Any], str, Ctx], None]] = {
+    "create": process_create_request,
+    "update": process_update_request,
+    "WIDGET_UPDATED": process_update_request,
+    "delete": process_delete_request,
+    "WIDGET_DELETED": process_delete_request,
+}
+
+
+def handle_request(data: dict[str, Any], storage_type: str, ctx: Ctx) -> None:
+    log.info("Processing: %s", data)
+
+    # Use "type" if available, otherwise fallback to "event"
+    request_type: Any = data.get("type") or data.get("event")
+    # A list or dict type can't be hashed; treat it as unknown like any other
+    handler = _HANDLERS.get(request_type) if isinstance(request_type, str) else None
+    if handler:
+        handler(data, storage_type, ctx)
     else:
-        raise ValueError("Invalid storage type")
+        log.warning("Unknown request type: %s", data)
+
+
+# A received batch is processed concurrently so its storage round trips
+# overlap on the shared clients. Requests for the same widget stay in one
+# sequence so an update never overtakes its create.
+REQUEST_WORKERS = 16
+
+_request_pool = ThreadPoolExecutor(max_workers=REQUEST_WORKERS)
+
+
+def process_requests(batch, storage_type, ctx):
+    """Handle a list of parsed requests; returns which ones succeeded."""
+    done = [False] * len(batch)
+
+    by_widget = defaultdict(list)
+    for i, data in enumerate(batch):
+        widget_id = data.get("widgetId")
+        # Non-string ids (numbers, lists, ...) still group, and never fail to hash
+        by_widget[widget_id if isinstance(widget_id, str) else repr(widget_id)].append(i)
+
+    def run(indices):
+        for i in indices:
+            try:
+                handle_request(batch[i], storage_type, ctx)
+            except Exception as e:
+                # Later requests for this widget wait for the redelivery
+                log.error("Error: %s", e, exc_info=True)
+                return
+            done[i] = True
+
+    list(_request_pool.map(run, by_widget.values()))
+    return done
+
+
+def parse_requests(items):
+    """Parse (ack, body) pairs; returns the request dicts and their acks.
+
+    Malformed JSON and JSON that isn't an object are logged and left
+    unacknowledged, so one bad body never takes down the rest of the batch.
+    """
+    batch, acks = [], []
+    for ack, body in items:
+        try:
+            data = orjson.loads(body)
+        except orjson.JSONDecodeError as e:
+            log.error("Error: %s", e, exc_info=True)
+            continue
+        if not isinstance(data, dict):
+            log.error("Request is not a JSON object: %s", body)
+            continue
+        batch.append(data)
+        acks.append(ack)
+    return batch, acks
+
+
+def handle_sqs_messages(messages, sqs_client, queue_url, storage_type, ctx,
+                        dead_letter_url=None, max_receives=SQS_MAX_RECEIVES):
+    finished, pending = [], []
+    for msg in messages:
+        if dead_letter_url and is_poison_message(msg, max_receives):
+            # Only acknowledged once the copy is safely on the dead-letter queue
+            log.error("Moving message received too many times to dead-letter queue: %s", msg["Body"])
+            try:
+                dead_letter_sqs(sqs_client, dead_letter_url, msg)
+            except Exception as e:
+                log.error("Error: %s", e, exc_info=True)
+                continue
+            finished.append(msg["ReceiptHandle"])
+            continue
+        pending.append((msg["ReceiptHandle"], msg["Body"]))
+
+    batch, receipts = parse_requests(pending)
+    done = process_requests(batch, storage_type, ctx)
+
+    finished.extend(rh for rh, ok in zip(receipts, done) if ok)
+    if finished:
+        delete_requests_sqs(sqs_client, queue_url, finished)
+
+
+def handle_s3_requests(fetched, s3_client, bucket_name, storage_type, ctx):
+    batch, keys = parse_requests(fetched)
+    done = process_requests(batch, storage_type, ctx)
+
+    for key, ok in zip(keys, done):
+        if ok:
+            delete_request_s3(s3_client, bucket_name, key)
+
+
+def _exit_on_sigterm(signum, frame):
+    # Raise through the main loop so its finally block flushes pending deletes
+    raise SystemExit(0)
 
 
 def main():
@@ -190,86 +653,82 @@ def main():
     parser.add_argument("--queue")               # queue name
     parser.add_argument("--request-bucket")      # request source (S3)
     parser.add_argument("--region", default="us-east-1")
+    parser.add_argument("--dead-letter-queue")   # queue name; off by default
+    parser.add_argument("--max-receives", type=int, default=SQS_MAX_RECEIVES)
     args = parser.parse_args()
 
+    log_listener = setup_logging()
+
     # ------------------- Backend storage clients -------------------
-    storage_table = storage_s3 = storage_sqs = None
+    storage_table = storage_writer = storage_s3 = storage_sqs = None
 
     if args.storage == "dynamodb":
-        dynamodb = boto3.resource("dynamodb", region_name=args.region)
+        dynamodb = get_resource("dynamodb", args.region)
         storage_table = dynamodb.Table(args.table)
+        storage_writer = DynamoBatchWriter(storage_table)
     elif args.storage == "bucket3":
-        storage_s3 = boto3.client("s3", region_name=args.region)
+        storage_s3 = get_client("s3", args.region)
     elif args.storage == "queue":
-        storage_sqs = boto3.client("sqs", region_name=args.region)
+        storage_sqs = get_client("sqs", args.region)
 
     # ------------------- Request source: SQS -------------------
     request_sqs = request_queue_url = None
     if args.queue:
-        request_sqs = boto3.client("sqs", region_name=args.region)
+        request_sqs = get_client("sqs", args.region)
         # Get full URL from queue name
         response = request_sqs.get_queue_url(QueueName=args.queue)
         request_queue_url = response["QueueUrl"]
 
+    dead_letter_url = None
+    if args.dead_letter_queue:
+        dead_letter_url = request_sqs.get_queue_url(QueueName=args.dead_letter_queue)["QueueUrl"]
+
     # ------------------- Request source: S3 -------------------
     request_s3 = None
     if args.request_bucket:
-        request_s3 = boto3.client("s3", region_name=args.region)
+        request_s3 = get_client("s3", args.region)
 
-    while True:
-        try:
-            # ------------------- FETCH REQUEST -------------------
-            if request_sqs:
-                msg = fetch_request_sqs(request_sqs, request_queue_url)
-                if not msg:
+    signal.signal(signal.SIGTERM, _exit_on_sigterm)
+
+    ctx = Ctx(
+        s3_client=storage_s3,
+        bucket_name=args.bucket,
+        dynamo_table=storage_table,
+        dynamo_writer=storage_writer,
+        queue_client=storage_sqs,
+        queue_url=request_queue_url
+    )
+
+    empty_polls = 0
+    try:
+        while True:
+            try:
+                # ------------------- REQUEST SOURCE: SQS -------------------
+                if request_sqs:
+                    messages = fetch_requests_sqs(request_sqs, request_queue_url)
+                    if not messages:
+                        continue
+
+                    handle_sqs_messages(messages, request_sqs, request_queue_url, args.storage,
+                                        ctx, dead_letter_url, args.max_receives)
                     continue
-                body = msg["Body"]
-                receipt = msg["ReceiptHandle"]
-                data = json.loads(body)
-                key = None
-            else:
-                key, body = fetch_request_s3(request_s3, args.request_bucket)
-                if key is None:
-                    time.sleep(0.1)
+
+                # ------------------- REQUEST SOURCE: S3 -------------------
+                fetched = fetch_requests_s3(request_s3, args.request_bucket, S3_PROCESS_BATCH)
+                if not fetched:
+                    time.sleep(s3_backoff_delay(empty_polls))
+                    empty_polls += 1
                     continue
-                data = json.loads(body)
-                receipt = None
-
-            logging.info(f"Processing: {data}")
-
-            # ------------------- PROCESS REQUEST -------------------
-            kwargs = {
-                "s3_client": storage_s3 if args.storage == "bucket3" else None,
-                "bucket_name": args.bucket,
-                "dynamo_table": storage_table if args.storage == "dynamodb" else None,
-                "queue_client": storage_sqs if args.storage == "queue" else None,
-                "queue_url": request_queue_url
-            }
+                empty_polls = 0
 
-            # Use "type" if available, otherwise fallback to "event"
-            request_type = data.get("type") or data.get("event")
-            match request_type:
-                case "create":
-                    process_create_request(data, args.storage, **kwargs)
-                case "update" | "WIDGET_UPDATED":
-                    process_update_request(data, args.storage, **kwargs)
-                case "delete" | "WIDGET_DELETED":
-                    process_delete_request(data, args.storage, **kwargs)
-                case _:
-                    logging.warning(f"Unknown request type: {data}")
-
-            # ------------------- DELETE REQUEST -------------------
-            if request_sqs and receipt:
-                request_sqs.delete_message(
-                    QueueUrl=request_queue_url,
-                    ReceiptHandle=receipt
-                )
-            elif request_s3 and key:
-                request_s3.delete_object(Bucket=args.request_bucket, Key=key)
+                handle_s3_requests(fetched, request_s3, args.request_bucket, args.storage, ctx)
 
-        except Exception as e:
-            logging.error(f"Error: {e}", exc_info=True)
- 
+            except Exception as e:
+                log.error("Error: %s", e, exc_info=True)
+    finally:
+        if request_s3:
+            flush_deletes_s3(request_s3, args.request_bucket)
+        log_listener.stop()
 
 
 if __name__ == "__main__":
@@ -4,16 +4,39 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")
 
 import unittest
 import json
+import threading
 import time
-import boto3
+from unittest import mock
+from botocore.exceptions import ClientError
 from moto import mock_aws
 
 from consumer import (
+    Ctx,
+    get_client,
+    get_resource,
+    DynamoBatchWriter,
+    S3_BACKOFF_BASE,
+    S3_BACKOFF_MAX,
+    s3_backoff_delay,
+    _s3_request_cache,
+    _s3_pending_deletes,
+    _sqs_cache,
     fetch_request_s3,
+    delete_request_s3,
+    flush_deletes_s3,
     fetch_request_sqs,
+    fetch_requests_sqs,
+    delete_requests_sqs,
+    is_poison_message,
     process_create_request,
     process_update_request,
-    process_delete_request
+    process_delete_request,
+    process_requests,
+    handle_request,
+    handle_sqs_messages,
+    handle_s3_requests,
+    _attr_placeholders,
+    _widget_key
 )
 
 REGION = "us-east-1"
@@ -29,9 +52,11 @@ QUEUE_NAME = "widget-queue"
 class TestConsumerS3(unittest.TestCase):
 
     def setUp(self):
-        self.s3 = boto3.client("s3", region_name=REGION)
+        self.s3 = get_client("s3", REGION)
         self.s3.create_bucket(Bucket=REQUEST_BUCKET)
         self.s3.create_bucket(Bucket=WIDGET_BUCKET)
+        _s3_request_cache.clear()
+        _s3_pending_deletes.clear()
 
     def test_fetch_request_s3_empty(self):
         key, body = fetch_request_s3(self.s3, REQUEST_BUCKET)
@@ -46,16 +71,67 @@ class TestConsumerS3(unittest.TestCase):
         )
         key, body = fetch_request_s3(self.s3, REQUEST_BUCKET)
         self.assertEqual(key, "req1.json")
+        self.assertIsInstance(body, bytes)
         data = json.loads(body)
         self.assertEqual(data["widgetId"], "1")
 
+    def test_fetch_request_s3_lists_once_per_batch(self):
+        for i in range(3):
+            self.s3.put_object(Bucket=REQUEST_BUCKET, Key=f"req{i}.json", Body="{}")
+
+        with mock.patch.object(self.s3, "list_objects_v2", wraps=self.s3.list_objects_v2) as listing:
+            keys = [fetch_request_s3(self.s3, REQUEST_BUCKET)[0] for _ in range(3)]
+
+        self.assertEqual(keys, ["req0.json", "req1.json", "req2.json"])
+        self.assertEqual(listing.call_count, 1)
+
+    def test_fetch_request_s3_skips_taken_keys(self):
+        self.s3.put_object(Bucket=REQUEST_BUCKET, Key="req1.json", Body="{}")
+        self.s3.put_object(Bucket=REQUEST_BUCKET, Key="req2.json", Body="{}")
+
+        # Another worker takes req2.json between the listing and the read
+        original_get = self.s3.get_object
+
+        def racing_get(**kwargs):
+            if kwargs["Key"] == "req2.json":
+                self.s3.delete_object(**kwargs)
+            return original_get(**kwargs)
+
+        with mock.patch.object(self.s3, "get_object", side_effect=racing_get):
+            first = fetch_request_s3(self.s3, REQUEST_BUCKET)
+            self.s3.delete_object(Bucket=REQUEST_BUCKET, Key=first[0])
+            second = fetch_request_s3(self.s3, REQUEST_BUCKET)
+
+        self.assertEqual(first[0], "req1.json")
+        self.assertEqual(second, (None, None))
+
+    def test_delete_request_s3_batches(self):
+        for i in range(3):
+            self.s3.put_object(Bucket=REQUEST_BUCKET, Key=f"req{i}.json", Body="{}")
+
+        with mock.patch.object(self.s3, "delete_objects", wraps=self.s3.delete_objects) as deleting:
+            for i in range(3):
+                delete_request_s3(self.s3, REQUEST_BUCKET, f"req{i}.json")
+            self.assertEqual(deleting.call_count, 0)
+            flush_deletes_s3(self.s3, REQUEST_BUCKET)
+            self.assertEqual(deleting.call_count, 1)
+
+        resp = self.s3.list_objects_v2(Bucket=REQUEST_BUCKET)
+        self.assertEqual(resp.get("Contents", []), [])
+
+    def test_invalid_storage_type(self):
+        with self.assertRaises(ValueError):
+            process_create_request({"widgetId": "1", "owner": "Al"}, "disk", Ctx())
+
+    def test_widget_key(self):
+        self.assertEqual(_widget_key("Sue Smith", "42"), "widgets/sue-smith/42")
+
     def test_process_create_request_s3(self):
         data = {"type": "create", "widgetId": "22", "owner": "Alice", "label": "Test"}
         process_create_request(
             data,
             "bucket3",
-            s3_client=self.s3,
-            bucket_name=WIDGET_BUCKET
+            Ctx(s3_client=self.s3, bucket_name=WIDGET_BUCKET)
         )
         obj = self.s3.get_object(Bucket=WIDGET_BUCKET, Key="widgets/alice/22")
         stored = json.loads(obj["Body"].read())
@@ -63,6 +139,28 @@ class TestConsumerS3(unittest.TestCase):
         self.assertEqual(stored["owner"], "Alice")
 
 
+@mock_aws
+class TestClientRegistry(unittest.TestCase):
+
+    def test_clients_are_reused(self):
+        self.assertIs(get_client("s3", REGION), get_client("s3", REGION))
+        self.assertIsNot(get_client("s3", REGION), get_client("s3", "us-west-2"))
+        self.assertIs(get_resource("dynamodb", REGION), get_resource("dynamodb", REGION))
+
+    def test_clients_use_keepalive_pool(self):
+        config = get_client("sqs", REGION).meta.config
+        self.assertTrue(config.tcp_keepalive)
+        self.assertGreaterEqual(config.max_pool_connections, 16)
+
+
+class TestS3Backoff(unittest.TestCase):
+
+    def test_backoff_grows_and_caps(self):
+        self.assertLess(s3_backoff_delay(0), 2 * S3_BACKOFF_BASE)
+        self.assertGreaterEqual(s3_backoff_delay(3), 8 * S3_BACKOFF_BASE)
+        self.assertLessEqual(s3_backoff_delay(5000), S3_BACKOFF_MAX + S3_BACKOFF_BASE)
+
+
 # ----------------------------------------------------
 # DynamoDB TESTS
 # ----------------------------------------------------
@@ -70,7 +168,7 @@ class TestConsumerS3(unittest.TestCase):
 class TestConsumerDynamo(unittest.TestCase):
 
     def setUp(self):
-        self.db = boto3.resource("dynamodb", region_name=REGION)
+        self.db = get_resource("dynamodb", REGION)
         self.db.create_table(
             TableName="widgets",
             KeySchema=[{"AttributeName": "id", "KeyType": "HASH"}],
@@ -87,12 +185,86 @@ class TestConsumerDynamo(unittest.TestCase):
             "label": "Dynamo Test",
             "otherAttributes": [{"name": "color", "value": "red"}]
         }
-        process_create_request(data, "dynamodb", dynamo_table=self.table)
+        process_create_request(data, "dynamodb", Ctx(dynamo_table=self.table))
 
         item = self.table.get_item(Key={"id": "5"})["Item"]
         self.assertEqual(item["owner"], "Bob")
         self.assertEqual(item["color"], "red")
 
+    def test_batched_create_then_update_dynamo(self):
+        ctx = Ctx(dynamo_table=self.table, dynamo_writer=DynamoBatchWriter(self.table))
+        create_data = {"type": "create", "widgetId": "7", "owner": "Bob", "label": "Old"}
+        update_data = {"type": "update", "widgetId": "7", "owner": "Bob", "label": "New"}
+
+        # Batched writes have landed by the time the handler returns
+        process_create_request(create_data, "dynamodb", ctx)
+        self.assertEqual(self.table.get_item(Key={"id": "7"})["Item"]["label"], "Old")
+
+        process_update_request(update_data, "dynamodb", ctx)
+        self.assertEqual(self.table.get_item(Key={"id": "7"})["Item"]["label"], "New")
+
+        process_delete_request(update_data, "dynamodb", ctx)
+        self.assertNotIn("Item", self.table.get_item(Key={"id": "7"}))
+
+    def test_batch_writer_reports_failed_writes(self):
+        writer = DynamoBatchWriter(self.table)
+        with self.assertRaises(ClientError):
+            writer.put_item(Item={"id": 5, "owner": "Bob"}).result()
+
+    def test_batch_writer_isolates_bad_write(self):
+        writer = DynamoBatchWriter(self.table, workers=0)
+        good = writer.put_item(Item={"id": "8", "owner": "Bob"})
+        bad = writer.put_item(Item={"id": 5, "owner": "Bob"})
+
+        # Start the worker only once both writes are queued, so they share a batch
+        threading.Thread(target=writer._run, daemon=True).start()
+
+        self.assertIsNone(good.result())
+        with self.assertRaises(ClientError):
+            bad.result()
+        self.assertIn("Item", self.table.get_item(Key={"id": "8"}))
+
+    def test_process_requests_keeps_widget_order(self):
+        ctx = Ctx(dynamo_table=self.table, dynamo_writer=DynamoBatchWriter(self.table))
+        batch = [
+            {"type": "create", "widgetId": "1", "owner": "Ann", "label": "Old"},
+            {"type": "create", "widgetId": "2", "owner": "Ben"},
+            {"type": "update", "widgetId": "1", "owner": "Ann", "label": "New"},
+            {"type": "create", "widgetId": "3"},  # no owner: fails
+            {"type": "delete", "widgetId": "3", "owner": "Cy"},
+        ]
+
+        done = process_requests(batch, "dynamodb", ctx)
+
+        # The delete for widget 3 waits for its failed create to be redelivered
+        self.assertEqual(done, [True, True, True, False, False])
+        self.assertEqual(self.table.get_item(Key={"id": "1"})["Item"]["label"], "New")
+        self.assertIn("Item", self.table.get_item(Key={"id": "2"}))
+
+    def test_handle_request_routes_event_names(self):
+        self.table.put_item(Item={"id": "11", "owner": "Mark"})
+        ctx = Ctx(dynamo_table=self.table)
+
+        handle_request({"event": "WIDGET_DELETED", "widgetId": "11"}, "dynamodb", ctx)
+        self.assertNotIn("Item", self.table.get_item(Key={"id": "11"}))
+
+        with self.assertLogs("consumer", level="WARNING"):
+            handle_request({"type": "rename", "widgetId": "11"}, "dynamodb", ctx)
+        with self.assertLogs("consumer", level="WARNING"):
+            handle_request({"type": ["create"], "widgetId": "11"}, "dynamodb", ctx)
+
+    def test_attr_placeholders(self):
+        self.assertEqual(
+            _attr_placeholders("size-unit"),
+            ("#size_unit = :size_unit", "#size_unit", ":size_unit")
+        )
+
+    def test_process_requests_groups_unhashable_ids(self):
+        batch = [{"type": "noop", "widgetId": ["a"]}, {"type": "noop", "widgetId": {"b": 1}}]
+        with self.assertLogs("consumer", level="WARNING"):
+            done = process_requests(batch, "dynamodb", Ctx(dynamo_table=self.table))
+        self.assertEqual(done, [True, True])
+
     def test_process_update_request_dynamo(self):
         # Insert item
         self.table.put_item(Item={"id": "10", "owner": "Mark", "label": "Old"})
@@ -106,7 +278,7 @@ class TestConsumerDynamo(unittest.TestCase):
             "otherAttributes": [{"name": "size", "value": "L"}]
         }
 
-        process_update_request(update_data, "dynamodb", dynamo_table=self.table)
+        process_update_request(update_data, "dynamodb", Ctx(dynamo_table=self.table))
 
         item = self.table.get_item(Key={"id": "10"})["Item"]
         self.assertEqual(item["label"], "Updated")
@@ -121,14 +293,15 @@ class TestConsumerDynamo(unittest.TestCase):
 class TestConsumerSQS(unittest.TestCase):
 
     def setUp(self):
-        self.sqs = boto3.client("sqs", region_name=REGION)
+        self.sqs = get_client("sqs", REGION)
         resp = self.sqs.create_queue(QueueName=QUEUE_NAME)
         self.queue_url = resp["QueueUrl"]
+        _sqs_cache.clear()
 
     # -------- TEST INPUT SQS FETCHER --------
 
     def test_fetch_request_sqs_empty(self):
-        msg = fetch_request_sqs(self.sqs, self.queue_url)
+        msg = fetch_request_sqs(self.sqs, self.queue_url, wait_seconds=0)
         self.assertIsNone(msg)
 
     def test_fetch_request_sqs_with_messages(self):
@@ -142,6 +315,34 @@ class TestConsumerSQS(unittest.TestCase):
         self.assertEqual(msg1["Body"], "msg1")
         self.assertEqual(msg2["Body"], "msg2")
 
+    def test_fetch_request_sqs_caches_per_queue(self):
+        other_url = self.sqs.create_queue(QueueName="other-queue")["QueueUrl"]
+        for body in ("a1", "a2"):
+            self.sqs.send_message(QueueUrl=self.queue_url, MessageBody=body)
+        self.sqs.send_message(QueueUrl=other_url, MessageBody="b1")
+
+        self.assertEqual(fetch_request_sqs(self.sqs, self.queue_url)["Body"], "a1")
+        self.assertEqual(fetch_request_sqs(self.sqs, other_url)["Body"], "b1")
+        self.assertEqual(fetch_request_sqs(self.sqs, self.queue_url)["Body"], "a2")
+
+    def test_delete_requests_sqs_batch(self):
+        for i in range(3):
+            self.sqs.send_message(QueueUrl=self.queue_url, MessageBody=f"msg{i}")
+        messages = fetch_requests_sqs(self.sqs, self.queue_url)
+        self.assertEqual(len(messages), 3)
+
+        delete_requests_sqs(self.sqs, self.queue_url, [m["ReceiptHandle"] for m in messages])
+
+        self.assertEqual(fetch_requests_sqs(self.sqs, self.queue_url, wait_seconds=0), [])
+
+    def test_fetch_request_sqs_reports_receive_count(self):
+        self.sqs.send_message(QueueUrl=self.queue_url, MessageBody="msg1")
+
+        msg = fetch_request_sqs(self.sqs, self.queue_url)
+        self.assertEqual(msg["Attributes"]["ApproximateReceiveCount"], "1")
+        self.assertFalse(is_poison_message(msg))
+        self.assertTrue(is_poison_message({"Attributes": {"ApproximateReceiveCount": "6"}}))
+
     # -------- TEST OUTPUT CREATE --------
 
     def test_process_create_request_sqs(self):
@@ -149,8 +350,7 @@ class TestConsumerSQS(unittest.TestCase):
         process_create_request(
             data,
             "queue",
-            queue_client=self.sqs,
-            queue_url=self.queue_url
+            Ctx(queue_client=self.sqs, queue_url=self.queue_url)
         )
 
         messages = self.sqs.receive_message(
@@ -172,8 +372,7 @@ class TestConsumerSQS(unittest.TestCase):
         process_update_request(
             data,
             "queue",
-            sqs_client=self.sqs,
-            queue_url=self.queue_url
+            Ctx(queue_client=self.sqs, queue_url=self.queue_url)
         )
 
         messages = self.sqs.receive_message(
@@ -197,8 +396,7 @@ class TestConsumerSQS(unittest.TestCase):
         process_delete_request(
             data,
             "queue",
-            sqs_client=self.sqs,
-            queue_url=self.queue_url
+            Ctx(queue_client=self.sqs, queue_url=self.queue_url)
         )
 
         messages = self.sqs.receive_message(
@@ -215,6 +413,123 @@ class TestConsumerSQS(unittest.TestCase):
         self.assertEqual(msg["MessageAttributes"]["DeleteType"]["StringValue"], "delete")
 
 
+# ----------------------------------------------------
+# MAIN LOOP BATCH TESTS
+# ----------------------------------------------------
+@mock_aws
+class TestMainLoopBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.sqs = get_client("sqs", REGION)
+        self.queue_url = self.sqs.create_queue(QueueName=QUEUE_NAME)["QueueUrl"]
+        _sqs_cache.clear()
+
+        db = get_resource("dynamodb", REGION)
+        db.create_table(
+            TableName="widgets",
+            KeySchema=[{"AttributeName": "id", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "id", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST"
+        )
+        self.table = db.Table("widgets")
+        self.ctx = Ctx(dynamo_table=self.table, dynamo_writer=DynamoBatchWriter(self.table))
+
+    def in_flight(self):
+        attrs = self.sqs.get_queue_attributes(
+            QueueUrl=self.queue_url,
+            AttributeNames=["ApproximateNumberOfMessages", "ApproximateNumberOfMessagesNotVisible"]
+        )["Attributes"]
+        return int(attrs["ApproximateNumberOfMessages"]) + int(attrs["ApproximateNumberOfMessagesNotVisible"])
+
+    def test_mixed_batch_acks_only_valid_requests(self):
+        bodies = [
+            json.dumps({"type": "create", "widgetId": "1", "owner": "Ann"}),
+            "[1]",
+            "null",
+            '"x"',
+            '{"incomplete": ',
+            json.dumps({"type": ["create"], "widgetId": "2"}),
+        ]
+        for body in bodies:
+            self.sqs.send_message(QueueUrl=self.queue_url, MessageBody=body)
+
+        messages = fetch_requests_sqs(self.sqs, self.queue_url)
+        self.assertEqual(len(messages), len(bodies))
+        handle_sqs_messages(messages, self.sqs, self.queue_url, "dynamodb", self.ctx)
+
+        self.assertEqual(self.table.get_item(Key={"id": "1"})["Item"]["owner"], "Ann")
+        # The four bodies that aren't JSON objects stay queued for redelivery;
+        # the unknown request type is logged and acknowledged
+        self.assertEqual(self.in_flight(), 4)
+
+
+    def test_requests_acked_only_after_writes_land(self):
+        # Batched writes must be durable before a request is acknowledged
+        acked = []
+
+        def check_written(widget_ids):
+            for widget_id in widget_ids:
+                self.assertIn("Item", self.table.get_item(Key={"id": widget_id}))
+                acked.append(widget_id)
+
+        def body(widget_id):
+            return json.dumps({"type": "create", "widgetId": widget_id, "owner": "Ann"})
+
+        # Slow every batch down so an early ack would see the item missing
+        real_batch_writer = self.table.batch_writer
+
+        def slow_batch_writer(**kwargs):
+            time.sleep(0.2)
+            return real_batch_writer(**kwargs)
+
+        def sqs_ack(QueueUrl, Entries):
+            check_written(e["ReceiptHandle"] for e in Entries)
+            return {}
+
+        def s3_ack(Bucket, Delete):
+            check_written(o["Key"] for o in Delete["Objects"])
+            return {}
+
+        # Receipt handles and keys double as widget ids since the acks are intercepted
+        messages = [{"ReceiptHandle": f"sqs-{i}", "Body": body(f"sqs-{i}")} for i in range(30)]
+        fetched = [(f"s3-{i}", body(f"s3-{i}").encode()) for i in range(30)]
+        s3 = get_client("s3", REGION)
+        with mock.patch.object(self.table, "batch_writer", side_effect=slow_batch_writer), \
+                mock.patch.object(self.sqs, "delete_message_batch", side_effect=sqs_ack), \
+                mock.patch.object(s3, "delete_objects", side_effect=s3_ack):
+            handle_sqs_messages(messages, self.sqs, self.queue_url, "dynamodb", self.ctx)
+            handle_s3_requests(fetched, s3, REQUEST_BUCKET, "dynamodb", self.ctx)
+            flush_deletes_s3(s3, REQUEST_BUCKET)
+
+        self.assertEqual(len(acked), 60)
+
+    def test_repeated_failures_kept_without_dead_letter_queue(self):
+        self.sqs.send_message(QueueUrl=self.queue_url, MessageBody="[1]")
+        messages = fetch_requests_sqs(self.sqs, self.queue_url)
+        messages[0]["Attributes"]["ApproximateReceiveCount"] = "6"
+
+        handle_sqs_messages(messages, self.sqs, self.queue_url, "dynamodb", self.ctx)
+        self.assertEqual(self.in_flight(), 1)
+
+    def test_repeated_failures_moved_to_dead_letter_queue(self):
+        dlq_url = self.sqs.create_queue(QueueName="widget-dlq")["QueueUrl"]
+        self.sqs.send_message(
+            QueueUrl=self.queue_url,
+            MessageBody="[1]",
+            MessageAttributes={"Source": {"DataType": "String", "StringValue": "test"}}
+        )
+        messages = fetch_requests_sqs(self.sqs, self.queue_url)
+        messages[0]["Attributes"]["ApproximateReceiveCount"] = "6"
+
+        handle_sqs_messages(messages, self.sqs, self.queue_url, "dynamodb", self.ctx,
+                            dead_letter_url=dlq_url)
+
+        self.assertEqual(self.in_flight(), 0)
+        moved = self.sqs.receive_message(QueueUrl=dlq_url, MessageAttributeNames=["All"])["Messages"]
+        self.assertEqual(moved[0]["Body"], "[1]")
+        self.assertEqual(moved[0]["MessageAttributes"]["Source"]["StringValue"], "test")
+
+
 # ----------------------------------------------------
 # INVALID JSON TEST
 # ----------------------------------------------------
@@ -222,8 +537,9 @@ class TestConsumerSQS(unittest.TestCase):
 class TestInvalidJSON(unittest.TestCase):
 
     def setUp(self):
-        self.s3 = boto3.client("s3", region_name=REGION)
+        self.s3 = get_client("s3", REGION)
         self.s3.create_bucket(Bucket=REQUEST_BUCKET)
+        _s3_request_cache.clear()
 
     def test_invalid_json(self):
         self.s3.put_object(